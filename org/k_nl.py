@@ -1,15 +1,261 @@
 import numpy as np
-import scipy.optimize
+import math
+import copy
 import matplotlib.pyplot as plt
 import sys
 
+try:
+    from numba import njit
+except ImportError:         # without numba the kernels run as plain python
+    def njit(*args,**kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+SQRT_2_3 = math.sqrt(2/3)
+SQRT_2_27 = math.sqrt(2/27)
+
+# --------------------------------#
+@njit(cache=True)
+def g_st(st,c):                     # Eq.(7), st = sin(3*theta)
+    # (sqrt(A+B*st)-(1+c^2)) / (2*(1-c)*st) rationalised: no st == 0 special case
+    S = math.sqrt((1+c**2)**2 + 4*c*(1-c**2)*st)
+    return 2*c*(1+c) / (S + (1+c**2))
+
+@njit(cache=True)
+def dg_st(st,c):                    # Eq.(45), dg/d(sin(3*theta))
+    S = math.sqrt((1+c**2)**2 + 4*c*(1-c**2)*st)
+    return -4*c**2*(1+c)*(1-c**2) / (S*(S + (1+c**2))**2)
+
+@njit(cache=True)
+def F1_ray(t,aa,ra,rr,c0,c1,c2,c3,H1,c):        # Eq.(6) and d/dt along the mapping ray
+    J2 = 0.5*(rr + 2*ra*t + aa*t*t)
+    dJ2 = ra + aa*t
+    J3 = -(c0 + 3*c1*t + 3*c2*t*t + c3*t*t*t)/3.0
+    dJ3 = -(c1 + 2*c2*t + c3*t*t)
+    if J2 <= 0.0:
+        R_bar,dR_bar,s3,ds3 = 0.0,0.0,0.0,0.0
+    else:
+        R_bar = math.sqrt(3*J2)
+        dR_bar = 1.5*dJ2/R_bar
+        s3 = J3/2 * (3/J2)**1.5
+        ds3 = dJ3/2 * (3/J2)**1.5 - 1.5*s3*dJ2/J2
+        if s3 <= -1.0 or s3 >= 1.0:
+            s3,ds3 = max(min(s3,1.0),-1.0),0.0
+    g_bar = g_st(s3,c)
+    F1 = R_bar - H1*g_bar
+    dF1 = dR_bar - H1*dg_st(s3,c)*ds3
+    return F1,dF1,R_bar,g_bar
+
+@njit(cache=True)
+def ray_t(R_bar,aa,ra,rr):          # larger t >= 1 with 1.5*|rij_bar|^2 = R_bar^2
+    D = ra*ra - aa*(rr - R_bar**2/1.5)
+    if D < 0.0:
+        return 1.0
+    return max((-ra + math.sqrt(D))/aa,1.0)
+
+@njit(cache=True)
+def F1_mapping_ratio(rij,alpha,H1,c):
+    # J2 and J3 of rij_bar = alpha + t*(rij-alpha) are polynomials in t (deviatoric, symmetric)
+    aa,ra,rr = 0.0,0.0,0.0
+    c0,c1,c2,c3 = 0.0,0.0,0.0,0.0
+    for i in range(3):
+        for j in range(3):
+            a_ij = rij[i,j] - alpha[i,j]
+            aa += a_ij*a_ij
+            ra += alpha[i,j]*a_ij
+            rr += alpha[i,j]*alpha[i,j]
+            for k in range(3):
+                a_jk = rij[j,k] - alpha[j,k]
+                a_ki = rij[k,i] - alpha[k,i]
+                c0 += alpha[i,j]*alpha[j,k]*alpha[k,i]
+                c1 += alpha[i,j]*alpha[j,k]*a_ki
+                c2 += alpha[i,j]*a_jk*a_ki
+                c3 += a_ij*a_jk*a_ki
+
+    F1,_,R_bar,g_bar = F1_ray(1.0,aa,ra,rr,c0,c1,c2,c3,H1,c)
+    if F1 > 0.0:                    # rij is outside of the boundary surface
+        return 1.0,R_bar,g_bar
+
+    # c <= g <= 1 brackets the root between R_bar = H1*c and R_bar = H1
+    t_lo,t_hi = ray_t(H1*c,aa,ra,rr),ray_t(H1,aa,ra,rr)
+    t = min(max(ray_t(H1*g_bar,aa,ra,rr),t_lo),t_hi)
+    for _ in range(100):
+        F1,dF1,R_bar,g_bar = F1_ray(t,aa,ra,rr,c0,c1,c2,c3,H1,c)
+        if F1 < 0.0:
+            t_lo = t
+        else:
+            t_hi = t
+        t_new = t - F1/dF1 if dF1 != 0.0 else t_lo
+        if not t_lo < t_new < t_hi:
+            t_new = 0.5*(t_lo+t_hi)     # bisection safeguard
+        if abs(t_new-t) < 1.e-12*max(t,1.0):
+            t = t_new
+            break
+        t = t_new
+
+    _,_,R_bar,g_bar = F1_ray(t,aa,ra,rr,c0,c1,c2,c3,H1,c)
+    return t,R_bar,g_bar
+
+@njit(cache=True)
+def Lode_angle(s):
+    J2 = 0.5*(s[0,0]*s[0,0] + s[0,1]*s[0,1] + s[0,2]*s[0,2]
+            + s[1,0]*s[1,0] + s[1,1]*s[1,1] + s[1,2]*s[1,2]
+            + s[2,0]*s[2,0] + s[2,1]*s[2,1] + s[2,2]*s[2,2])
+    J3 = -(s[0,0]*(s[1,1]*s[2,2]-s[1,2]*s[2,1])
+           - s[0,1]*(s[1,0]*s[2,2]-s[1,2]*s[2,0])
+           + s[0,2]*(s[1,0]*s[2,1]-s[1,1]*s[2,0]))
+    if J2 == 0.0:
+        s3 = 0.0
+    else:
+        s3 = J3/2 * (3/J2)**1.5
+        s3 = max(s3,-1.0)
+        s3 = min(s3,1.0)
+    theta = math.asin(s3)/3.0
+    return theta
+
+@njit(cache=True)
+def stress_variable(stress,pmin):   # p and R = sqrt(1.5*rij*rij), Eq.(3)
+    p = (stress[0,0]+stress[1,1]+stress[2,2])/3.0
+    s2 = 0.0
+    for i in range(3):
+        for j in range(3):
+            s_ij = stress[i,j]-p if i == j else stress[i,j]
+            s2 += s_ij*s_ij
+    return p,math.sqrt(1.5*s2)/max(p,pmin)
+
+@njit(cache=True)
+def ddot(A,B):                      # A_ij*B_ij of 3x3 arrays
+    s = 0.0
+    for i in range(3):
+        for j in range(3):
+            s += A[i,j]*B[i,j]
+    return s
+
+# explicit loops below: numba compiles small array expressions very slowly
+@njit(cache=True)
+def tensor_n(sij,r_bar,R_bar,g_bar,c,eps):     # nij: unit deviatoric part of dF1/dr at r_bar
+    nij = np.zeros((3,3))
+    if abs(R_bar) >= eps:
+        st_bar = math.sin(3*Lode_angle(sij))
+        dg_bar = dg_st(st_bar,c)
+        a = R_bar*g_bar + 3*R_bar*st_bar*dg_bar
+        b = 9*dg_bar
+        cc = 1.5/(R_bar*g_bar)**2
+        for i in range(3):
+            for j in range(3):
+                rr_ij = r_bar[i,0]*r_bar[j,0] + r_bar[i,1]*r_bar[j,1] + r_bar[i,2]*r_bar[j,2]
+                nij[i,j] = (a*r_bar[i,j] + b*rr_ij)*cc
+        tr = (nij[0,0]+nij[1,1]+nij[2,2])/3.0
+        for i in range(3):
+            nij[i,i] -= tr
+
+    n_abs = math.sqrt(ddot(nij,nij))
+    inv = 1.0/n_abs if n_abs > 0.0 else math.nan
+    for i in range(3):
+        for j in range(3):
+            nij[i,j] *= inv
+    return nij
+
+@njit(cache=True)
+def tensor_m(rij):                  # mij = rij/|rij|
+    mij = np.zeros((3,3))
+    r_abs = math.sqrt(ddot(rij,rij))
+    if r_abs > 0.0:
+        for i in range(3):
+            for j in range(3):
+                mij[i,j] = rij[i,j] / r_abs
+    return mij
+
+@njit(cache=True)
+def tensor_TZ(nij,mij,rij,Ge,Ke,D1,D2,Kp1,Zd,ef1,ef2,R):
+    # Zd is the denominator of Zij, which is also that of B when R != 0
+    nr = ddot(nij,rij)
+    if ef1 or ef2 or R == 0.0:
+        B = 0.0
+    else:
+        nm = ddot(nij,mij)
+        B = (2*Ge*nm - SQRT_2_3*Ke*D2*nr) / Zd
+
+    Tij,Zij = np.zeros((3,3)),np.zeros((3,3))
+    if not ef1:
+        Td = 2*Ge - SQRT_2_3*Ke*D1*(nr+B) + Kp1
+        for i in range(3):
+            for j in range(3):
+                Tij[i,j] = 2*Ge*nij[i,j] / Td
+            Tij[i,i] -= Ke*(nr+B) / Td
+
+    if not ef2:
+        for i in range(3):
+            for j in range(3):
+                Zij[i,j] = -SQRT_2_3*Ke*D1*Tij[i,j] / Zd
+            Zij[i,i] += Ke / Zd
+    return B,Tij,Zij
+
+@njit(cache=True)
+def elastic_stiffness_dot(G,nu,Lm):     # elastic_stiffness(G)_ijpq * Lm_pqkl
+    mu,rlambda = G,2*G*nu/(1-2*nu)
+    E_Lm = np.empty((3,3,3,3))
+    for k in range(3):
+        for l in range(3):
+            rlambda_trLm = rlambda*(Lm[0,0,k,l] + Lm[1,1,k,l] + Lm[2,2,k,l])
+            for i in range(3):
+                for j in range(3):
+                    E_Lm[i,j,k,l] = 2*mu*Lm[i,j,k,l]
+                E_Lm[i,i,k,l] += rlambda_trLm
+    return E_Lm
+
+@njit(cache=True)
+def tensor_Ep(G,nu,nij,Tij,mij,Zij,D1,D2,ef1,ef2,R):
+    nD,mD = np.zeros((3,3)),np.zeros((3,3))     # Tij (Zij) = 0 when elastic
+    for i in range(3):
+        if not ef1:
+            for j in range(3):
+                nD[i,j] = nij[i,j]
+            nD[i,i] += SQRT_2_27*D1
+        if not ef2:
+            if R == 0.0:
+                mD[i,i] = SQRT_2_27
+            else:
+                for j in range(3):
+                    mD[i,j] = mij[i,j]
+                mD[i,i] += SQRT_2_27*D2
+
+    Lm = np.empty((3,3,3,3))                    # Lm0 - Lm1 - Lm2
+    for i in range(3):
+        for j in range(3):
+            for k in range(3):
+                for l in range(3):
+                    Lm0 = 1.0 if i == k and j == l else 0.0     # Dikjl
+                    Lm[i,j,k,l] = Lm0 - nD[i,j]*Tij[k,l] - mD[i,j]*Zij[k,l]
+    return elastic_stiffness_dot(G,nu,Lm)
+
+def fro(A,B):                       # A_ij*B_ij
+    return A.ravel() @ B.ravel()
+
+# --------------------------------#
 class StateParameters:
     def __init__(self,strain,stress,dstrain,dstress,ef1=False,ef2=False):
-        self.strain = np.copy(strain)
-        self.stress = np.copy(stress)
-        self.dstress = np.copy(dstress)
-        self.dstrain = np.copy(dstrain)
+        self.strain = strain.copy()
+        self.stress = stress.copy()
+        self.dstress = dstress.copy()
+        self.dstrain = dstrain.copy()
         self.pmin = 1.0
+        self.sij = np.empty((3,3))
+        self.rij = np.empty((3,3))
+
+        self.set_stress_variable()
+        self.set_stress_increment()
+
+        self.elastic_flag1 = ef1
+        self.elastic_flag2 = ef2
+
+    def set_state(self,strain,stress,dstrain,dstress,ef1=False,ef2=False):
+        # next step: refresh the state in place instead of building a new StateParameters
+        np.copyto(self.strain,strain)
+        np.copyto(self.stress,stress)
+        np.copyto(self.dstress,dstress)
+        np.copyto(self.dstrain,dstrain)
 
         self.set_stress_variable()
         self.set_stress_increment()
@@ -19,14 +265,14 @@ class StateParameters:
 
 
     def set_stress_variable(self):
-        self.p = (self.stress[0,0]+self.stress[1,1]+self.stress[2,2])/3.0
-        self.sij = self.stress - self.p*np.eye(3)
-        self.rij = self.sij / max(self.p,self.pmin)
-        self.R = np.sqrt(1.5*np.power(self.rij,2).sum())     # Eq.(3)
+        self.p,self.R = stress_variable(self.stress,self.pmin)     # Eq.(3)
+        np.copyto(self.sij,self.stress)
+        self.sij.flat[::4] -= self.p                            # diagonal
+        np.divide(self.sij,max(self.p,self.pmin),out=self.rij)
 
     def set_stress_increment(self):
-        stress = self.stress + self.dstress
-        p = (stress[0,0]+stress[1,1]+stress[2,2])/3.0
+        s,ds = self.stress,self.dstress
+        p = ((s[0,0]+ds[0,0])+(s[1,1]+ds[1,1])+(s[2,2]+ds[2,2]))/3.0
         self.dp = p - self.p
 
 
@@ -37,6 +283,7 @@ class Li2002:
                  d2=1,h4=3.5,a=1,b1=0.005,b2=2,b3=0.01):
         # Elastic parameters
         self.G0,self.nu = G0,nu
+        self.fn = 2*(1+nu)/(3*(1-2*nu))     # K/G, Eq.(17)
         # Critical state parameters
         self.M,self.c,self.eg,self.rlambdac,self.xi = M,c,eg,rlambdac,xi
         # parameters associated with dr-mechanisms
@@ -49,6 +296,11 @@ class Li2002:
         # minimum epsillon
         self.eps = 1.e-6
 
+        # identity tensors
+        self.I3 = np.eye(3)
+        self.Dijkl = np.einsum('ij,kl->ijkl',self.I3,self.I3)
+        self.Dikjl = np.einsum('ij,kl->ikjl',self.I3,self.I3)
+
         # stress parameters
         self.pr = 101.e3
         self.pmin = 100.0
@@ -68,13 +320,16 @@ class Li2002:
 
     # -------------------------------------------------------------------------------------- #
     def vector_to_matrix(self,vec):
-        mat = np.array([[vec[0],vec[3],vec[5]],
-                        [vec[3],vec[1],vec[4]],
-                        [vec[5],vec[4],vec[2]]])
+        vec = np.asarray(vec)
+        mat = np.empty((3,3),dtype=vec.dtype)
+        mat[0,0],mat[1,1],mat[2,2] = vec[0],vec[1],vec[2]
+        mat[0,1] = mat[1,0] = vec[3]
+        mat[1,2] = mat[2,1] = vec[4]
+        mat[0,2] = mat[2,0] = vec[5]
         return mat
 
     def matrix_to_vector(self,mat):
-        vec = np.array([mat[0,0],mat[1,1],mat[2,2],mat[0,1],mat[1,2],mat[2,0]])
+        vec = mat[[0,1,2,0,1,2],[0,1,2,1,2,0]]
         return vec
 
     def clear_strain(self):
@@ -83,7 +338,7 @@ class Li2002:
     # -------------------------------------------------------------------------------------- #
     def set_strain_variable(self,strain_mat):
         ev = strain_mat[0,0]+strain_mat[1,1]+strain_mat[2,2]
-        dev_strain = strain_mat - ev/3.0 * np.eye(3)
+        dev_strain = strain_mat - ev/3.0 * self.I3
         gamma = np.sqrt(2.0/3.0*np.power(dev_strain,2).sum())
         return ev,gamma
 
@@ -95,49 +350,21 @@ class Li2002:
 
     # -------------------------------------------------------------------------------------- #
     def set_stress_variable(self,stress):
-        p = (stress[0,0]+stress[1,1]+stress[2,2])/3.0
-        dev_stress = stress - p*np.eye(3)
-        r_stress = dev_stress / max(p,self.pmin)
-        R = np.sqrt(1.5*np.power(r_stress,2).sum())
-        return p,R
+        return stress_variable(stress,self.pmin)
 
     # -------------------------------------------------------------------------------------- #
     def Lode_angle(self,dev_stress):
-        J2 = 0.5*np.power(dev_stress,2).sum()
-        J3 = -np.linalg.det(dev_stress)
-        if J2 == 0.0:
-            s3 = 0.0
-        else:
-            s3 = J3/2 * (3/J2)**1.5
-            s3 = max(s3,-1.0)
-            s3 = min(s3,1.0)
-        theta = np.arcsin(s3)/3.0
-        return theta
+        return Lode_angle(dev_stress)
 
     def g_theta(self,dev_stress):            # Eq.(7)
         theta = self.Lode_angle(dev_stress)
-        st = np.sin(3*theta)
-        if st == 0.0:
-            g1 = self.c*(1+self.c)
-            g2 = 1+self.c**2
-        else:
-            g1 = np.sqrt((1+self.c**2)**2 + 4*self.c*(1-self.c**2)*st) - (1+self.c**2)
-            g2 = 2*(1-self.c)*st
-        return g1/g2
+        return self.g_Lode(theta)
+
+    def g_Lode(self,theta):
+        return g_st(np.sin(3*theta),self.c)
 
     def dg_theta(self,theta):                 # Eq.(45)
-        st = np.sin(3*theta)
-        if st == 0.0:
-            g1 = -self.c**2*(1-self.c)*(1+self.c)**2
-            g2 = (1+self.c**2)**3
-            dg = g1/g2
-        else:
-            g11 = self.c*(1+self.c)
-            g12 = st*np.sqrt((1+self.c**2)**2+4*self.c*(1-self.c**2)*st)
-            g21 = np.sqrt((1+self.c**2)**2 + 4*self.c*(1-self.c**2)*st) - (1+self.c**2)
-            g22 = 2*(1-self.c)*st * st
-            dg = g11/g12 - g21/g22
-        return dg
+        return dg_st(np.sin(3*theta),self.c)
 
     # -------------------------------------------------------------------------------------- #
     def state_parameter(self,e,p):
@@ -147,64 +374,59 @@ class Li2002:
     # -------------------------------------------------------------------------------------- #
     def elastic_modulus(self,e,p):
         G = self.G0*(2.97-e)**2 / (1+e) * np.sqrt(max(p,self.pmin)*self.pr)  # Eq.(16)
-        K = G*2*(1+self.nu)/(3*(1-2*self.nu))                           # Eq.(17)
+        K = G*self.fn                                                   # Eq.(17)
         return G,K
 
     def elastic_stiffness(self,G):
         mu,rlambda = G,2*G*self.nu/(1-2*self.nu)
-        Dijkl = np.einsum('ij,kl->ijkl',np.eye(3),np.eye(3))
-        Dikjl = np.einsum('ij,kl->ikjl',np.eye(3),np.eye(3))
-        Ee = rlambda*Dijkl + 2*mu*Dikjl
+        Ee = rlambda*self.Dijkl
+        Ee += 2*mu*self.Dikjl
         return Ee
 
-    def isotropic_compression_stiffness(self,e,p):
+    def isotropic_compression_modulus(self,e,p):
         G,K = self.elastic_modulus(e,p)
-        fn = 2*(1+self.nu)/(3*(1-2*self.nu))
-        K2 = G*fn*self.h4 / (self.h4 + np.sqrt(2/3)*fn*self.d2)   #  Elastic + Eq.(29)
-        G2 = K2 / fn
+        K2 = G*self.fn*self.h4 / (self.h4 + SQRT_2_3*self.fn*self.d2)   #  Elastic + Eq.(29)
+        G2 = K2 / self.fn
+        return G2,K2
+
+    def isotropic_compression_stiffness(self,e,p):
+        G2,_ = self.isotropic_compression_modulus(e,p)
         E2 = self.elastic_stiffness(G2)
         return E2
 
     # -------------------------------------------------------------------------------------- #
     def set_mapping_stress(self,sp):
-        def mapping_r(t,rij,alpha):
-            rij_bar = alpha + t*(rij-alpha)
-            g_bar = self.g_theta(rij_bar)
-            R_bar = np.sqrt(1.5*np.power(rij_bar,2).sum())
-            return rij_bar,R_bar,g_bar
-
-        def F1_boundary_surface(t,*args):               # Eq.(6)
-            rij,alpha = args
-            _,R_bar,g_bar = mapping_r(t,rij,alpha)
-            return R_bar-self.H1*g_bar
-
         if sp.elastic_flag1:
-            self.alpha = np.copy(sp.rij)
-        if sp.elastic_flag2:
-            self.beta = np.copy(sp.p)
+            self.alpha = sp.rij.copy()
 
-        if np.linalg.norm(sp.rij-self.alpha) < 1.e-6:  # Elastic behavior
+        dr = sp.rij-self.alpha
+        if math.sqrt((dr*dr).sum()) < 1.e-6:  # Elastic behavior
             sp.elastic_flag1 = True
         else:
-            if F1_boundary_surface(1.0,sp.rij,self.alpha) > 0.0:
-                sp.rij_bar,sp.R_bar,sp.g_bar = mapping_r(1.0,sp.rij,self.alpha)
+            t,sp.R_bar,sp.g_bar = F1_mapping_ratio(sp.rij,self.alpha,self.H1,self.c)    # Eq.(6)
+            sp.rij_bar = self.alpha + t*(sp.rij-self.alpha)
+            if t == 1.0:
                 self.H1 = sp.R_bar/sp.g_bar
                 sp.rho1_ratio = 1.0
             else:
-                t = scipy.optimize.brentq(F1_boundary_surface,1.0,1.e6,args=(sp.rij,self.alpha))
-                sp.rij_bar,sp.R_bar,sp.g_bar = mapping_r(t,sp.rij,self.alpha)
-                sp.rho1_ratio = np.copy(t)      # rho1_ratio = rho1_bar / rho1
+                sp.rho1_ratio = float(t)      # rho1_ratio = rho1_bar / rho1
+
+        self.set_mapping_stress_dp(sp)
+
+    def set_mapping_stress_dp(self,sp):
+        if sp.elastic_flag2:
+            self.beta = float(sp.p)
 
         if np.abs(sp.p-self.beta) == 0.0:  # Elastic behavior
             sp.elastic_flag2 = True
         else:
             if sp.p > self.H2:
-                self.H2 = np.copy(sp.p)
+                self.H2 = float(sp.p)
             if sp.dp > 0.0:
                 if sp.p <= self.beta:
                     sp.elastic_flag2 = True
                     return
-                sp.p_bar = np.copy(self.H2)
+                sp.p_bar = float(self.H2)
             elif sp.dp < 0.0:
                 if self.beta <= sp.p:
                     sp.elastic_flag2 = True
@@ -240,10 +462,26 @@ class Li2002:
             D1 = self.d1*(np.exp(self.m*psi)*np.sqrt(rho1_ratio) - R_Mg)
             return D1
 
+        sp.Ge,sp.Ke = self.elastic_modulus(self.e,sp.p)
+        sp.psi = self.state_parameter(self.e,sp.p)
+        sp.g = self.g_theta(sp.sij)
+
+        if sp.elastic_flag1:
+            sp.Kp1,sp.Kp1_b = 0.0,0.0
+            sp.D1 = 0.0
+        else:
+            h = scaling_factor(self.e,sp.rho1_ratio)
+            sp.h = h
+            sp.Kp1,sp.Kp1_b = plastic_modulus1(sp.Ge,sp.R_bar,sp.g_bar,sp.rho1_ratio,h,sp.psi)
+            sp.D1 = dilatancy1(sp.R,sp.g,sp.rho1_ratio,sp.psi)
+
+        self.set_parameters_dp(sp)
+
+    def set_parameters_dp(self,sp):
         def plastic_modulus2(G,Mg_R,rho2_ratio,sign):   #  Eq.(25)
             Kp2 = G*self.h4*Mg_R * (rho2_ratio)**self.a*sign
             if rho2_ratio == 1.0 and sign > 0.0:
-                Kp2_b = np.copy(Kp2)
+                Kp2_b = float(Kp2)
             else:
                 Kp2_b = 0.0
             return Kp2,Kp2_b
@@ -255,20 +493,9 @@ class Li2002:
                 D2 = 0.0
             return D2
 
-        sp.Ge,sp.Ke = self.elastic_modulus(self.e,sp.p)
-        sp.psi = self.state_parameter(self.e,sp.p)
-        sp.g = self.g_theta(sp.sij)
-
-        if sp.elastic_flag1:
-            sp.Kp1_b = 0.0
-        else:
-            h = scaling_factor(self.e,sp.rho1_ratio)
-            sp.h = h
-            sp.Kp1,sp.Kp1_b = plastic_modulus1(sp.Ge,sp.R_bar,sp.g_bar,sp.rho1_ratio,h,sp.psi)
-            sp.D1 = dilatancy1(sp.R,sp.g,sp.rho1_ratio,sp.psi)
-
         if sp.elastic_flag2 or sp.R == 0.0:
-            sp.Kp2_b = 0.0
+            sp.Kp2,sp.Kp2_b = 0.0,0.0
+            sp.D2 = 0.0
         else:
             sign = sp.dp/np.abs(sp.dp)
             Mg_R = self.M*sp.g/sp.R
@@ -278,81 +505,28 @@ class Li2002:
 
     # -------------------------------------------------------------------------------------- #
     def set_parameter_nm(self,sp):
-        def dF1_r(r_bar,R_bar,theta_bar,g_bar,dg_bar):
-            if np.abs(R_bar) < self.eps:
-                return np.zeros((3,3))
-            st_bar = np.sin(3*theta_bar)
-            a = R_bar*g_bar + 3*R_bar*st_bar*dg_bar
-            b = 9*dg_bar
-            c = 1.5/(R_bar*g_bar)**2
-            rr_bar = np.einsum('im,jm->ij',r_bar,r_bar)
-            return (a*r_bar + b*rr_bar)*c
-
-        if not sp.elastic_flag1:
-            theta_bar = self.Lode_angle(sp.sij)
-            dg_bar = self.dg_theta(theta_bar)
-            dF1 = dF1_r(sp.rij_bar,sp.R_bar,theta_bar,sp.g_bar,dg_bar)
-            dF1_tr = np.trace(dF1)
-            nij = dF1 - np.eye(3,3)*dF1_tr/3.0
-            sp.nij = nij / np.linalg.norm(nij)
-
-        r_abs = np.linalg.norm(sp.rij)
-        if r_abs == 0.0:
-            sp.mij = np.zeros((3,3))
+        if sp.elastic_flag1:
+            sp.nij = np.zeros((3,3))
         else:
-            sp.mij = sp.rij / r_abs         # mij = rij/|rij|
+            sp.nij = tensor_n(sp.sij,sp.rij_bar,sp.R_bar,sp.g_bar,self.c,self.eps)
+        sp.mij = tensor_m(sp.rij)
 
     # -------------------------------------------------------------------------------------- #
     def set_parameter_TZ(self,sp):
-        if sp.elastic_flag1 or sp.elastic_flag2 or sp.R == 0.0:
-            sp.B = 0.0
-        else:
-            nm = np.einsum("ij,ij",sp.nij,sp.mij)
-            nr = np.einsum("ij,ij",sp.nij,sp.rij)
-            Bu = 2*sp.Ge*nm - np.sqrt(2/3)*sp.Ke*sp.D2*nr
-            Bd = np.sqrt(2/3)*sp.Ke*sp.D2 + sp.Kp2
-            sp.B = Bu / Bd
-
-        if sp.elastic_flag1:
-            sp.Tij = np.zeros((3,3))
-        else:
-            nr = np.einsum("ij,ij",sp.nij,sp.rij)
-            Tu = 2*sp.Ge*sp.nij - sp.Ke*(nr+sp.B)*np.eye(3)
-            Td = 2*sp.Ge - np.sqrt(2/3)*sp.Ke*sp.D1*(nr+sp.B) + sp.Kp1
-            sp.Tij = Tu / Td
-
         if sp.elastic_flag2:
-            sp.Zij = np.zeros((3,3))
+            Zd = 1.0                        # not used
+        elif sp.R == 0.0:
+            Kp2_D2 = sp.Ge*self.h4/self.d2 * sp.rho2_ratio**self.a
+            Zd = SQRT_2_3*sp.Ke + Kp2_D2
         else:
-            Zu = sp.Ke*np.eye(3) - np.sqrt(2/3)*sp.Ke*sp.D1*sp.Tij
-            if sp.R == 0.0:
-                Kp2_D2 = sp.Ge*self.h4/self.d2 * sp.rho2_ratio**self.a
-                Zd = np.sqrt(2/3)*sp.Ke + Kp2_D2
-            else:
-                Zd = np.sqrt(2/3)*sp.Ke*sp.D2 + sp.Kp2
-            sp.Zij = Zu / Zd
+            Zd = SQRT_2_3*sp.Ke*sp.D2 + sp.Kp2
+        sp.B,sp.Tij,sp.Zij = tensor_TZ(sp.nij,sp.mij,sp.rij,sp.Ge,sp.Ke,sp.D1,sp.D2,sp.Kp1,Zd, \
+                                       sp.elastic_flag1,sp.elastic_flag2,sp.R)
 
     # -------------------------------------------------------------------------------------- #
     def set_tensor_Ep(self,sp):
-        Lm0 = np.einsum('pk,ql->pqkl',np.eye(3),np.eye(3))
-        if sp.elastic_flag1:
-            Lm1 = np.einsum('pq,kl->pqkl',np.zeros((3,3)),np.zeros((3,3)))
-        else:
-            nD = sp.nij + np.sqrt(2/27)*sp.D1*np.eye(3)
-            Lm1 = np.einsum("pq,kl->pqkl",nD,sp.Tij)
-
-        if sp.elastic_flag2:
-            Lm2 = np.einsum('pq,kl->pqkl',np.zeros((3,3)),np.zeros((3,3)))
-        elif sp.R == 0:
-            mD = np.sqrt(2/27)*np.eye(3)
-            Lm2 = np.einsum("pq,kl->pqkl",mD,sp.Zij)
-        else:
-            mD = sp.mij + np.sqrt(2/27)*sp.D2*np.eye(3)
-            Lm2 = np.einsum("pq,kl->pqkl",mD,sp.Zij)
-
-        Lm = Lm0 - Lm1 - Lm2
-        Ee = self.elastic_stiffness(sp.Ge)
-        sp.Ep = np.einsum('ijpq,pqkl->ijkl',Ee,Lm)
+        sp.Ep = tensor_Ep(sp.Ge,self.nu,sp.nij,sp.Tij,sp.mij,sp.Zij,sp.D1,sp.D2, \
+                          sp.elastic_flag1,sp.elastic_flag2,sp.R)
 
     # -------------------------------------------------------------------------------------- #
     def check_unload(self,sp):
@@ -361,32 +535,36 @@ class Li2002:
         self.set_parameter_nm(sp)
         self.set_parameter_TZ(sp)
 
-        dL1 = np.einsum("ij,ij",sp.Tij,sp.dstrain)
+        dL1 = fro(sp.Tij,sp.dstrain)
         if dL1 < 0.0:
             elastic_flag1 = True
-            self.alpha = np.copy(sp.rij)
+            self.alpha = sp.rij.copy()
         else:
             elastic_flag1 = False
 
-        dL2 = np.einsum("ij,ij",sp.Zij,sp.dstrain)
+        dL2 = fro(sp.Zij,sp.dstrain)
         if dL2 < 0.0:
             elastic_flag2 = True
-            self.beta = np.copy(sp.p)
-            print(self.beta)
+            self.beta = float(sp.p)
         else:
             elastic_flag2 = False
 
         return elastic_flag1,elastic_flag2
 
     # -------------------------------------------------------------------------------------- #
-    def update_parameters(self,sp):
-        self.set_mapping_stress(sp)
-        self.set_parameters(sp)
-        self.set_parameter_nm(sp)
+    def update_parameters(self,sp,dr_mechanism_set=False):
+        if dr_mechanism_set:        # sp already holds the dr-mechanism of this stress state
+            sp.elastic_flag2 = False
+            self.set_mapping_stress_dp(sp)
+            self.set_parameters_dp(sp)
+        else:
+            self.set_mapping_stress(sp)
+            self.set_parameters(sp)
+            self.set_parameter_nm(sp)
         self.set_parameter_TZ(sp)
 
-        dL1 = np.einsum("ij,ij",sp.Tij,sp.dstrain)
-        dL2 = np.einsum("ij,ij",sp.Zij,sp.dstrain)
+        dL1 = fro(sp.Tij,sp.dstrain)
+        dL2 = fro(sp.Zij,sp.dstrain)
 #        print(" dL:",sp.elastic_flag1,dL1,sp.elastic_flag2,dL2)
 
         if not sp.elastic_flag1:
@@ -397,15 +575,6 @@ class Li2002:
             self.H2 += sp.Kp2_b*dL2
 
 
-    # -------------------------------------------------------------------------------------- #
-    def plastic_stiffness(self,sp):
-        self.set_mapping_stress(sp)
-        self.set_parameters(sp)
-        self.set_parameter_nm(sp)
-        self.set_parameter_TZ(sp)
-        self.set_tensor_Ep(sp)
-        return sp.Ep
-
     # -------------------------------------------------------------------------------------- #
     def solve_strain(self,stress_mat,E):
         b = stress_mat.flatten()
@@ -414,22 +583,31 @@ class Li2002:
         strain_mat = np.reshape(x,(3,3))
         return strain_mat
 
+    def solve_strain_isotropic(self,stress_mat,G,K):
+        # inverse of elastic_stiffness(G): strain = dev(stress)/2G + tr(stress)/9K * I
+        sm = (stress_mat[0,0]+stress_mat[1,1]+stress_mat[2,2])/3.0
+        strain_mat = stress_mat / (2*G)
+        strain_mat.flat[::4] += sm/(3*K) - sm/(2*G)
+        return strain_mat
+
     def solve_strain_with_consttain(self,strain_given,stress_given,E,deformation):
         # deformation: True => deform (stress given), False => constrain (strain given)
-        d = deformation.flatten()
+        #              or the flat indices of the True components (see np.flatnonzero)
+        d = np.ravel(deformation)
+        if d.dtype == bool:
+            d = np.flatnonzero(d)
         A = np.reshape(E,(9,9))
 
-        strain = np.copy(strain_given.flatten())
+        strain = strain_given.flatten()
         strain[d] = 0.0                        # [0.0,0.0,given,...]
-        stress_constrain = np.dot(A,strain)
-        stress = np.copy(stress_given.flatten()) - stress_constrain
+        stress = stress_given.flatten() - A @ strain
 
         stress_mask = stress[d]
-        A_mask = A[d][:,d]
+        A_mask = A[np.ix_(d,d)]
         strain_mask = np.linalg.solve(A_mask,stress_mask)
 
         strain[d] = strain_mask
-        stress = np.dot(A,strain)
+        stress = A @ strain
 
         return np.reshape(strain,(3,3)), np.reshape(stress,(3,3))
 
@@ -440,30 +618,43 @@ class Li2002:
         return dstrain_elastic,dstress_elastic
 
     def plastic_deformation(self,dstrain_given,dstress_given,deformation,sp0):
+        # sp0 holds the current strain & stress state with dstress_given as its increment
         ef1,ef2 = self.check_unload(sp0)
-        sp = StateParameters(self.strain,self.stress,dstrain_given,dstress_given,ef1=ef1,ef2=ef2)
-        Ep = self.plastic_stiffness(sp)
-        dstrain_ep,dstress_ep = self.solve_strain_with_consttain(dstrain_given,dstress_given,Ep,deformation)
 
-        sp2 = StateParameters(self.strain,self.stress,dstrain_ep,dstress_ep)
-        self.update_parameters(sp2)
+        # unloading only switches mechanisms to elastic: re-evaluate sp0 in place
+        sp = sp0
+        if (ef1 and not sp.elastic_flag1) or (ef2 and not sp.elastic_flag2):
+            sp.elastic_flag1 = sp.elastic_flag1 or ef1
+            sp.elastic_flag2 = sp.elastic_flag2 or ef2
+            self.set_parameters(sp)
+            self.set_parameter_nm(sp)
+            self.set_parameter_TZ(sp)
+        self.set_tensor_Ep(sp)
+        dstrain_ep,dstress_ep = self.solve_strain_with_consttain(dstrain_given,dstress_given,sp.Ep,deformation)
+
+        # only the dp-mechanism depends on the increment
+        sp2 = copy.copy(sp)
+        sp2.dstrain,sp2.dstress = dstrain_ep,dstress_ep
+        # own arrays: the caller may refresh sp0 in place (StateParameters.set_state)
+        sp2.strain,sp2.stress = sp.strain.copy(),sp.stress.copy()
+        sp2.sij,sp2.rij = sp.sij.copy(),sp.rij.copy()
+        sp2.set_stress_increment()
+        self.update_parameters(sp2,dr_mechanism_set=True)
 
-        dstrain = np.copy(dstrain_ep)
-        dstress = np.copy(dstress_ep)
-        return dstrain,dstress,sp2
+        return dstrain_ep,dstress_ep,sp2
 
     # -------------------------------------------------------------------------------------- #
     def isotropic_compression(self,e0,compression_stress,nstep=1000):
         dcp = compression_stress / nstep
-        self.e = np.copy(e0)
+        self.e = float(e0)
 
         dstress_vec = np.array([dcp,dcp*2,dcp,0,0,0])
         dstress = self.vector_to_matrix(dstress_vec)
 
         for i in range(0,nstep):
             p,_ = self.set_stress_variable(self.stress)
-            E = self.isotropic_compression_stiffness(self.e,p)
-            dstrain = self.solve_strain(dstress,E)
+            G2,K2 = self.isotropic_compression_modulus(self.e,p)
+            dstrain = self.solve_strain_isotropic(dstress,G2,K2)
 
             self.stress += dstress
             self.strain += dstrain
@@ -475,8 +666,8 @@ class Li2002:
     # -------------------------------------------------------------------------------------- #
     def triaxial_compression(self,e0,compression_stress,de=0.0001,emax=0.20,print_result=False,plot=False):
         self.isotropic_compression(e0,compression_stress)
-        self.e0 = np.copy(e0)
-        self.e = np.copy(e0)
+        self.e0 = float(e0)
+        self.e = float(e0)
 
         p,_ = self.set_stress_variable(self.stress)
         self.beta,self.H2 = p,p
@@ -490,13 +681,18 @@ class Li2002:
 
         deformation_vec = np.array([True,True,False,True,True,True],dtype=bool)
         deformation = self.vector_to_matrix(deformation_vec)
+        deformation = np.flatnonzero(deformation)     # deformed components
+
+        sp = StateParameters(self.strain,self.stress,dstrain_input,dstress_input)
 
-        gamma_list,R_list = [],[]
-        ev_list = []
+        gamma_arr,R_arr = np.empty(nstep),np.empty(nstep)
+        ev_arr,p_arr = np.empty(nstep),np.empty(nstep)
         for i in range(0,nstep):
+            sp.set_state(self.strain,self.stress,dstrain_input,dstress_input)
+
             p,R = self.set_stress_variable(self.stress)
-            dstrain,dstress = \
-                self.plastic_deformation(dstrain_input,dstress_input,deformation)
+            dstrain,dstress,_ = \
+                self.plastic_deformation(dstrain_input,dstress_input,deformation,sp)
 
             self.stress += dstress
             self.strain += dstrain
@@ -504,35 +700,35 @@ class Li2002:
             ev,gamma = self.set_strain_variable(self.strain)
             self.e = self.e0 - ev*(1+self.e0)
 
-            print(gamma,R,ev,p)
-
-            gamma_list += [gamma]
-            R_list += [R]
-            ev_list += [ev]
+            gamma_arr[i] = gamma
+            R_arr[i] = R
+            ev_arr[i] = ev
+            p_arr[i] = p
 
         if print_result:
+            sys.stdout.write("".join(f"{gamma} {R} {ev} {p}\n"
+                for gamma,R,ev,p in zip(gamma_arr,R_arr,ev_arr,p_arr)))
             print("+++ triaxial_compression +++")
             print(" e0:",self.e0)
             print("  e:",self.e)
 
         if plot:
             plt.figure()
-            plt.plot(gamma_list,R_list)
+            plt.plot(gamma_arr,R_arr)
             plt.show()
 
-            plt.plot(gamma_list,ev_list)
+            plt.plot(gamma_arr,ev_arr)
             plt.show()
 
     # -------------------------------------------------------------------------------------- #
     def cyclic_shear_test(self,e0,compression_stress,sr=0.2,print_result=False,plot=False):
-        def cycle_load(nstep,amp,i):
-            tau = amp*np.sin((i+1)/nstep*2*np.pi*2)#2hz
-            tau0 = amp*np.sin((i+0)/nstep*2*np.pi*2)
-            return tau - tau0
+        def cycle_load(nstep,amp):
+            tau = amp*np.sin(np.arange(nstep+1)/nstep*2*np.pi*2)#2hz
+            return tau[1:] - tau[:-1]
 
         self.isotropic_compression(e0,compression_stress)
-        self.e0 = np.copy(e0)
-        self.e = np.copy(e0)
+        self.e0 = float(e0)
+        self.e = float(e0)
 
         p0,_ = self.set_stress_variable(self.stress)
         self.beta,self.H2 = p0,p0
@@ -548,25 +744,34 @@ class Li2002:
 
         deformation_vec = np.array([False,False,False,True,True,True],dtype=bool)
         deformation = self.vector_to_matrix(deformation_vec)
+        deformation = np.flatnonzero(deformation)     # deformed components
 
-        sp0 = StateParameters(self.strain,self.stress,dstrain_input,dstress_input)
+        sp = StateParameters(self.strain,self.stress,dstrain_input,dstress_input)
+        sp0 = sp
 
-        gamma_list,tau_list = [],[]
-        p_list = []
-        stressxx,stressyy,stresszz=[],[],[]#σxx,yy,zz
-        step_list,ep_list = [],[]
+        dtau_cycle = cycle_load(nstep,15000)#実際は振幅が約20kpa
+        istep = np.arange(nstep)
+        dtau_table = np.empty((ncycle,nstep))
+        for ic in range(0,ncycle):
+            if ic<5:
+                dtau_table[ic] = dtau_cycle*((istep+ic*nstep)/nstep*2/10)
+            elif 15<ic:
+                dtau_table[ic] = dtau_cycle*((20000-(istep+ic*nstep))/nstep*2/10)
+            else:
+                dtau_table[ic] = dtau_cycle
+
+        nall = ncycle*nstep
+        gamma_arr,tau_arr = np.empty(nall),np.empty(nall)
+        p_arr = np.empty(nall)
+        stressxx,stressyy,stresszz = np.empty(nall),np.empty(nall),np.empty(nall)#σxx,yy,zz
+        step_arr = np.arange(nall)
         for ic in range(0,ncycle):
             print("N :",ic+1)
             for i in range(0,nstep):
-                dtau = cycle_load(nstep,15000,i)#実際は振幅が約20kpa
-                if ic<5:
-                    dtau*=(i+ic*nstep)/nstep*2/10
-                elif 15<ic:
-                    dtau *=(20000-(i+ic*nstep))/nstep*2/10
-                dstress_vec = np.array([0.0,0.0,0.0,dtau,0.0,0])
-                dstress_input = self.vector_to_matrix(dstress_vec)
+                dtau = dtau_table[ic,i]
+                dstress_input[0,1] = dstress_input[1,0] = dtau
 
-                sp = StateParameters(self.strain,self.stress,sp0.dstrain,dstress_input)
+                sp.set_state(self.strain,self.stress,sp0.dstrain,dstress_input)
 
                 p,R = self.set_stress_variable(self.stress)
                 dstrain,dstress,sp0 = \
@@ -578,24 +783,25 @@ class Li2002:
                 ev,gamma = self.set_strain_variable(self.strain)
                 self.e = self.e0 - ev*(1+self.e0)
 
-                gamma_list += [self.strain[0,1]]
-                tau_list += [self.stress[0,1]]
-                stressxx+=[self.stress[0,0]]
-                stressyy +=[self.stress[1,1]]
-                stresszz +=[self.stress[2,2]]
-                p_list += [p]
-                step_list += [ic*nstep+i]
-                ep_list += [(p0-p)/p0]
+                k = ic*nstep+i
+                gamma_arr[k] = self.strain[0,1]
+                tau_arr[k] = self.stress[0,1]
+                stressxx[k] = self.stress[0,0]
+                stressyy[k] = self.stress[1,1]
+                stresszz[k] = self.stress[2,2]
+                p_arr[k] = p
+
+        ep_arr = (p0-p_arr)/p0
 
         if plot:
             plt.figure()
-            plt.plot(step_list,(40000+20000+20000)/3-np.array(p_list))
+            plt.plot(step_arr,(40000+20000+20000)/3-p_arr)
             plt.show()
-            plt.plot(p_list,tau_list)
+            plt.plot(p_arr,tau_arr)
             plt.show()
-            plt.plot(step_list,stressxx,label="x")
-            plt.plot(step_list,stressyy,label="y")
-            plt.plot(step_list,stresszz,label="z")
+            plt.plot(step_arr,stressxx,label="x")
+            plt.plot(step_arr,stressyy,label="y")
+            plt.plot(step_arr,stresszz,label="z")
             plt.legend()
             plt.show()
 